@@ -6,10 +6,13 @@ Usage: python app.py
 Then open http://localhost:5001 in your browser.
 """
 
+import os
+
 # Import the Flask app instance from the web module
 from web.app import app
 
 # Only run the server if this file is executed directly (not imported)
 if __name__ == '__main__':
     # Start Flask development server
-    app.run(debug=True, host='0.0.0.0', port=5001)
+    # Debug mode is opt-in via FLASK_DEBUG=1; the reloader stays off so the model only loads once
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', use_reloader=False, host='0.0.0.0', port=5001)
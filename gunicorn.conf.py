@@ -0,0 +1,49 @@
+"""
+Gunicorn settings for running the web app in production.
+
+Usage: gunicorn -c gunicorn.conf.py web.app:app
+
+On CPU-only machines the app is preloaded, so the pix2tex model is loaded once
+in the master process before the workers are forked. Workers then
+share the weights copy-on-write instead of each loading their own ~500MB copy.
+
+On GPU machines preloading is turned off. CUDA can't be used in a process forked
+after the parent touched it, so each worker imports the app (and loads the model
+onto the GPU) itself, after the fork.
+"""
+
+import os
+
+# Ask PyTorch to check for a GPU through NVML, which doesn't initialize CUDA in this
+# (master) process - otherwise the check itself would break CUDA in forked workers
+os.environ.setdefault('PYTORCH_NVML_BASED_CUDA_CHECK', '1')
+import torch
+
+bind = os.environ.get('WEB_BIND', '0.0.0.0:5001')
+
+use_cuda = torch.cuda.is_available()
+
+# Load web.app (and the model) before forking workers - CPU only, see above
+preload_app = not use_cuda
+
+# One worker by default. Threads let the micro-batcher in that worker group concurrent
+# requests into one model call. On CPU-only machines, raise WEB_WORKERS to use more cores.
+workers = int(os.environ.get('WEB_WORKERS', 1))
+threads = int(os.environ.get('WEB_THREADS', 8))
+
+# On GPU machines there is always exactly one worker: each worker would load (and compile)
+# its own fp16 copy of the model onto the GPU, and one worker's micro-batcher already
+# keeps the GPU busy with batched calls
+if use_cuda and workers != 1:
+    print(f"GPU found: ignoring WEB_WORKERS={workers} and running a single worker")
+    workers = 1
+
+# Model inference can take a few seconds per request. Without preloading, the worker
+# also loads and compiles the model before it first checks in, which takes longer
+timeout = 120 if preload_app else 300
+
+
+def post_fork(server, worker):
+    """Split the CPU cores between workers so they don't fight over the same threads."""
+    # Setting CPU thread counts doesn't touch CUDA, so this is safe in the forked worker
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // workers))
@@ -1,6 +1,7 @@
 """
 Main CLI script for whiteboard to LaTeX conversion.
 Run from command line: python main.py path/to/image.jpg
+Add --durable to fsync the .tex output before exiting.
 """
 
 # System utilities for command line arguments and file operations
@@ -11,25 +12,39 @@ from src.preprocess import preprocess_image
 # Import the model wrapper that runs the LaTeX recognition
 from src.model_infer import Pix2TexModel
 
+# Image types picked up when a folder is passed instead of a single file
+IMAGE_EXTENSIONS = {'.png', '.jpg', '.jpeg', '.gif', '.bmp'}
+
 
 def main():
     """
     Main workflow: validate input, preprocess image, run model, save result.
     This is the command-line interface version of the application.
     """
+    # --durable forces the output to be flushed to disk before we exit
+    args = sys.argv[1:]
+    durable = '--durable' in args
+    if durable:
+        args.remove('--durable')
+    
     # Make sure user provided an image path as an argument
-    if len(sys.argv) != 2:
-        print("Usage: python main.py <image_path>")
+    if len(args) != 1:
+        print("Usage: python main.py [--durable] <image_path | folder>")
         print("Example: python main.py samples/example.jpg")
         sys.exit(1)
     
-    input_image_path = sys.argv[1]
+    input_image_path = args[0]
     
-    # Verify the file actually exists before we try to process it
+    # Verify the path actually exists before we try to process it
     if not os.path.exists(input_image_path):
-        print(f"Error: Image file not found: {input_image_path}")
+        print(f"Error: Image file or folder not found: {input_image_path}")
         sys.exit(1)
     
+    # A folder of images is preprocessed up front and recognised in one batched call
+    if os.path.isdir(input_image_path):
+        process_folder(input_image_path, durable)
+        return
+    
     # Step 1: Clean up and enhance the image using CV techniques
     print(f"Preprocessing image: {input_image_path}")
     os.makedirs("output", exist_ok=True)
@@ -68,8 +83,7 @@ def main():
     os.makedirs("output", exist_ok=True)
     output_file = os.path.join("output", "output.tex")
     try:
-        with open(output_file, 'w', encoding='utf-8') as f:
-            f.write(latex_result)
+        save_latex(output_file, latex_result, durable)
         print(f"LaTeX saved to {output_file}")
     except Exception as e:
         print(f"Error saving output: {e}")
@@ -83,6 +97,82 @@ def main():
         print(f"Warning: Could not remove temporary file: {e}")
 
 
+def save_latex(output_file, latex_result, durable=False):
+    """
+    Write a LaTeX result to a file.
+    Only fsyncs when durable is True - normally the OS can flush it whenever it likes.
+    """
+    # One large buffer means the whole result goes out in a single write call
+    with open(output_file, 'w', encoding='utf-8', buffering=1 << 20) as f:
+        f.write(latex_result)
+        if durable:
+            f.flush()
+            os.fsync(f.fileno())
+
+
+def process_folder(folder_path, durable=False):
+    """
+    Batch workflow: preprocess every image in a folder, then run the model once on all of them.
+    Each result is saved as output/<image file name>.tex (e.g. eq.png -> eq.png.tex), so
+    images that only differ by extension don't overwrite each other.
+    """
+    image_names = sorted(
+        name for name in os.listdir(folder_path)
+        if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS
+    )
+    if not image_names:
+        print(f"Error: No images found in {folder_path}")
+        sys.exit(1)
+    
+    # Step 1: Preprocess every image into its own temp file
+    os.makedirs("output", exist_ok=True)
+    preprocessed_paths = []
+    try:
+        for index, name in enumerate(image_names):
+            print(f"Preprocessing image: {name}")
+            # Numbered temp files - names like eq.png and eq.jpg would otherwise clash
+            preprocessed_path = os.path.join("output", f"preprocessed_{index}.png")
+            preprocess_image(os.path.join(folder_path, name), preprocessed_path)
+            preprocessed_paths.append(preprocessed_path)
+    except Exception as e:
+        print(f"Error during preprocessing: {e}")
+        sys.exit(1)
+    
+    # Step 2: Load the model once for the whole folder
+    try:
+        model = Pix2TexModel()
+    except Exception as e:
+        print(f"Error loading model: {e}")
+        sys.exit(1)
+    
+    # Step 3: Similar-sized images are decoded together in a single batch
+    print(f"Running LaTeX recognition on {len(image_names)} images...")
+    try:
+        latex_results = model.predict_batch(preprocessed_paths)
+    except Exception as e:
+        print(f"Error during inference: {e}")
+        sys.exit(1)
+    
+    # Step 4: Print and save each result under the original image name
+    for name, latex_result in zip(image_names, latex_results):
+        print(f"{name}: {latex_result}")
+        output_file = os.path.join("output", name + ".tex")
+        try:
+            save_latex(output_file, latex_result, durable)
+        except Exception as e:
+            print(f"Error saving output: {e}")
+            sys.exit(1)
+    print("LaTeX files saved to output/")
+    
+    # Clean up the temporary preprocessed image files
+    for preprocessed_path in preprocessed_paths:
+        try:
+            if os.path.exists(preprocessed_path):
+                os.remove(preprocessed_path)
+        except Exception as e:
+            print(f"Warning: Could not remove temporary file: {e}")
+
+
 if __name__ == "__main__":
     main()
 
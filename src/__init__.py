@@ -7,9 +7,9 @@ You can do: from src import preprocess_image
 """
 
 # Import the main functions so they're available at package level
-from .preprocess import preprocess_image
-from .model_infer import Pix2TexModel
+from .preprocess import preprocess_image, preprocess_image_array
+from .model_infer import Pix2TexModel, MicroBatcher
 
 # Explicitly define what gets exported when someone does "from src import *"
-__all__ = ['preprocess_image', 'Pix2TexModel']
+__all__ = ['preprocess_image', 'preprocess_image_array', 'Pix2TexModel', 'MicroBatcher']
 
@@ -1,11 +1,60 @@
 """
 Model inference module for LaTeX recognition using pix2tex.
+
+Image decoding and resizing here go through Pillow. Installing Pillow-SIMD instead
+(see README) speeds those steps up with no code changes, mostly for large JPEG inputs.
 """
 
+# Standard library pieces for the micro-batching queue
+import contextlib
+import os
+import queue
+import threading
+import time
+
 # pix2tex provides the LatexOCR class - the actual deep learning model
-from pix2tex.cli import LatexOCR
+from pix2tex.cli import LatexOCR, minmax_size
+# Helpers pix2tex uses internally to pad images and turn tokens back into text
+from pix2tex.utils import pad, post_process, token2str
+from pix2tex.dataset.transforms import test_transform
+# Munch is the attribute-style dict pix2tex uses for its settings
+from munch import Munch
 # PIL Image is needed because pix2tex expects Image objects, not file paths
-from PIL import Image
+from PIL import Image, ImageDraw
+import numpy as np
+import torch
+
+
+# Images whose sizes round up to the same multiple of this share a batch
+BUCKET_SIZE = 64
+# Micro-batching limits: flush after this many images or this long, whichever comes first
+MAX_BATCH = 8
+MAX_WAIT_MS = 20
+
+# Formulas rendered for the torch.compile warm-up - different lengths give different image sizes
+WARMUP_FORMULAS = ['E = mc^2', 'a^2 + b^2 = c^2', 'f(x) = sum_{n=0}^{N} a_n x^n + int_0^1 g(t) dt']
+
+
+@contextlib.contextmanager
+def _mmap_torch_load():
+    """
+    Make torch.load memory-map checkpoints and load weights only, for as long as the block runs.
+    LatexOCR calls torch.load itself with no way to pass options, so it is patched temporarily.
+    """
+    original = torch.load
+
+    def load(f, *args, **kwargs):
+        try:
+            return original(f, *args, mmap=True, weights_only=True, **kwargs)
+        except Exception:
+            # PyTorch < 2.1 or an old-style checkpoint - load it the normal way
+            return original(f, *args, **kwargs)
+
+    torch.load = load
+    try:
+        yield
+    finally:
+        torch.load = original
 
 
 class Pix2TexModel:
@@ -14,26 +63,384 @@ class Pix2TexModel:
     Loads the model once when created, then reuses it for all predictions.
     This is much faster than loading the model every time.
     """
-    
-    def __init__(self):
-        """Load the pretrained model into memory - this happens once at startup."""
+
+    def __init__(self, compile: bool = False):
+        """
+        Load the pretrained model into memory - this happens once at startup.
+
+        Args:
+            compile: If True and a GPU is available, compile the encoder/decoder with
+                     torch.compile. Call warm_up() afterwards (on the thread that serves
+                     predictions) to do the slow first compilation up front. Worth it for the
+                     server, where the compile time is paid once for many predictions.
+        """
         print("Loading pix2tex model...")
+        # Use the GPU when there is one - LatexOCR defaults to CPU unless told otherwise
+        self.use_cuda = torch.cuda.is_available()
         # This downloads the model on first run (~500MB), then caches it
-        self.model = LatexOCR()
-        print("Model loaded successfully!")
-    
-    def predict(self, image_path: str) -> str:
+        # Checkpoints are memory-mapped while loading so they aren't held in RAM twice
+        with _mmap_torch_load():
+            self.model = LatexOCR(arguments=Munch({
+                'config': 'settings/config.yaml',
+                'checkpoint': 'checkpoints/weights.pth',
+                'no_cuda': not self.use_cuda,
+                'no_resize': False,
+            }))
+        if self.use_cuda:
+            # Half-precision weights: half the bytes to read per decoding step, and tensor cores do the math
+            self.model.model.half()
+            torch.backends.cuda.matmul.allow_tf32 = True
+        print(f"Model loaded successfully on {self.model.args.device}!")
+
+        # Original (uncompiled) encoder and decoder network, kept while the compiled ones are in use
+        self._eager_modules = None
+        # torch.compile errors that mean "run this without compiling" (filled in by _compile)
+        self._compile_errors = ()
+        if compile:
+            self._compile()
+
+    @property
+    def is_compiled(self) -> bool:
+        """True while the torch.compile'd encoder/decoder are in use."""
+        return self._eager_modules is not None
+
+    def _compile(self):
+        """Wrap the encoder and decoder network with torch.compile (call warm_up() afterwards)."""
+        if not self.use_cuda:
+            # On CPU the compile time isn't won back, so the plain model is used
+            print("No GPU found, skipping torch.compile")
+            return
+        if not hasattr(torch, 'compile'):
+            print("Warning: torch.compile needs PyTorch 2.0+, running uncompiled")
+            return
+
+        import torch._dynamo.exc as dynamo_exc
+        self._compile_errors = tuple(
+            getattr(dynamo_exc, name)
+            for name in ('BackendCompilerFailed', 'TorchRuntimeError', 'InternalTorchDynamoError')
+            if hasattr(dynamo_exc, name)
+        )
+
+        model = self.model.model
+        self._eager_modules = (model.encoder, model.decoder.net)
+        # The decoder's generate() loop calls decoder.net once per token, so that is what gets compiled
+        # No CUDA graphs ("reduce-overhead"): pix2tex's decoder has no KV cache, so its input
+        # grows by one token every step, and image and batch sizes vary too - a graph would
+        # be recorded for nearly every call. dynamic=True lets one compiled kernel set
+        # handle all those shapes instead of recompiling for each
+        model.encoder = torch.compile(model.encoder, mode="default", fullgraph=False, dynamic=True)
+        model.decoder.net = torch.compile(model.decoder.net, mode="default", fullgraph=False, dynamic=True)
+
+    def warm_up(self):
+        """
+        Run a few realistic formulas through the compiled model so compilation happens now,
+        not on the first real requests. Call it from the thread that will serve predictions.
+        Does nothing if the model isn't compiled.
+        """
+        if not self.is_compiled:
+            return
+
+        print("Compiling pix2tex model (first call takes a while)...")
+        try:
+            prepared = [self.prepare(self._render_formula(text)) for text in WARMUP_FORMULAS]
+            # Batch size 1 and a full batch - dynamic shapes still treat size 1 specially
+            for img in prepared:
+                self.predict_prepared([img], exact_sizes=True)
+            self.predict_prepared([prepared[-1]] * MAX_BATCH, exact_sizes=True)
+        except self._compile_errors as e:
+            # If compilation breaks on this setup, fall back to the plain model
+            if self.is_compiled:
+                self._use_eager(e)
+            return
+        # _generate may already have fallen back to the plain model during the warm-up
+        if self.is_compiled:
+            print("Model compiled successfully!")
+
+    def _use_eager(self, error: Exception):
+        """Swap the compiled modules back for the original ones."""
+        model = self.model.model
+        model.encoder, model.decoder.net = self._eager_modules
+        self._eager_modules = None
+        print(f"Warning: torch.compile failed, running uncompiled: {error}")
+
+    @staticmethod
+    def _render_formula(text: str) -> Image.Image:
+        """Draw a line of formula-like text, roughly the size of a typical cropped equation."""
+        # The default bitmap font is tiny, so draw small and scale up to get realistic stroke sizes
+        img = Image.new('L', (8 * len(text) + 20, 24), 255)
+        ImageDraw.Draw(img).text((10, 6), text, fill=0)
+        return img.resize((img.size[0] * 3, img.size[1] * 3), Image.Resampling.NEAREST)
+
+    def predict(self, image) -> str:
         """
         Take a preprocessed image and convert it to LaTeX text.
-            
+        Accepts a PIL Image, a NumPy array (e.g. from preprocess_image_array) or a file path.
+
         Returns:
             LaTeX string like "E = mc^2" or "\\frac{a}{b}"
         """
+        # A single image is just a batch of one - same code path as predict_batch
+        return self.predict_batch([image])[0]
+
+    def predict_batch(self, images: list, batch_size: int = MAX_BATCH) -> list:
+        """
+        Convert several preprocessed images to LaTeX in as few model calls as possible.
+        Images with a similar size are decoded together (the smaller ones padded with white
+        to the largest size in the group), so the encoder and the autoregressive decoder run
+        once per group instead of once per image. An image decoded alone, or with images of
+        exactly its size, gets no extra padding - the same input LatexOCR would use.
+        Padded images can come out slightly differently than they would on their own.
+
+        Args:
+            images: List of PIL Images, NumPy arrays or file paths
+            batch_size: Most images decoded together at once (limits memory on big folders)
+
+        Returns:
+            List of LaTeX strings, in the same order as the input images
+        """
+        prepared = [self.prepare(image) for image in images]
+        return self.predict_prepared(prepared, batch_size)
+
+    def prepare(self, image) -> Image.Image:
+        """
+        Load one image and resize/pad it for the model (what LatexOCR does before the encoder).
+        This part runs image by image, so callers on different threads can do it in parallel
+        and only hand the results to predict_prepared for the batched model call.
+        """
+        with self._inference_context():
+            return self._prepare(self._load(image))
+
+    def predict_prepared(self, prepared: list, batch_size: int = MAX_BATCH, exact_sizes: bool = False) -> list:
+        """
+        Batched encoder + decoder call on images that already went through prepare().
+
+        Args:
+            prepared: List of images returned by prepare()
+            batch_size: Most images decoded together at once
+            exact_sizes: If True, only images of exactly the same size are batched together,
+                         so nothing is padded and each result is the same as decoding it alone
+
+        Returns:
+            List of LaTeX strings, in the same order as the input images
+        """
+        with self._inference_context():
+            return self._predict_prepared(prepared, batch_size, exact_sizes)
+
+    def _predict_prepared(self, prepared: list, batch_size: int, exact_sizes: bool) -> list:
+        """Batched prediction - callers go through predict_prepared, which sets up the inference context."""
+        # Group images by size - only same-shaped tensors can be stacked
+        groups = {}
+        for index, img in enumerate(prepared):
+            key = img.size if exact_sizes else self._bucket(img)
+            groups.setdefault(key, []).append(index)
+
+        # Split large groups into chunks of at most batch_size images
+        chunks = [
+            (size, indices[start:start + batch_size])
+            for size, indices in groups.items()
+            for start in range(0, len(indices), batch_size)
+        ]
+
+        args = self.model.args
+        results = [None] * len(prepared)
+        for _, indices in chunks:
+            # Only pad as far as the largest image actually in this chunk
+            width = max(prepared[index].size[0] for index in indices)
+            height = max(prepared[index].size[1] for index in indices)
+            tensors = []
+            for index in indices:
+                img = prepared[index]
+                if img.size != (width, height):
+                    # Pad on the right/bottom with white, the same way pix2tex's own pad() does
+                    canvas = Image.new('L', (width, height), 255)
+                    canvas.paste(img, (0, 0))
+                    img = canvas
+                tensors.append(test_transform(image=np.array(img.convert('RGB')))['image'][:1])
+            batch = torch.stack(tensors).to(args.device)
+
+            # One encoder pass and one batched decode for the whole group
+            dec = self._generate(batch)
+            # generate() keeps sampling every row until all rows have finished, so rows that
+            # hit EOS early have junk after it - blank out everything from each row's first EOS
+            dec = dec.masked_fill((dec == args.eos_token).cumsum(1) > 0, args.pad_token)
+            for index, text in zip(indices, token2str(dec, self.model.tokenizer)):
+                results[index] = post_process(text)
+        return results
+
+    def _generate(self, batch: torch.Tensor) -> torch.Tensor:
+        """Run the encoder and decoder on a batch, dropping back to eager mode if compiled code fails."""
+        temperature = self.model.args.get('temperature', .25)
+        try:
+            return self.model.model.generate(batch, temperature=temperature)
+        except self._compile_errors as e:
+            if not self.is_compiled:
+                raise
+            # A shape the warm-up didn't cover can still fail to compile - retry without it
+            # Anything else (out of memory, bad input) is a real error and is raised as usual
+            self._use_eager(e)
+            return self.model.model.generate(batch, temperature=temperature)
+
+    def _inference_context(self):
+        """No autograd bookkeeping, plus fp16 autocast when running on the GPU."""
+        stack = contextlib.ExitStack()
+        stack.enter_context(torch.inference_mode())
+        if self.use_cuda:
+            stack.enter_context(torch.autocast('cuda', dtype=torch.float16))
+        return stack
+
+    @staticmethod
+    def _load(image) -> Image.Image:
+        """Accept a PIL Image, a NumPy array or a path to an image file."""
         # pix2tex needs a PIL Image object, not just a file path
         # This is important - passing a string path will cause errors
-        img = Image.open(image_path)
-        
-        # Run the model - it uses a CNN encoder and transformer decoder internally
-        latex_result = self.model(img)
-        return latex_result
+        if isinstance(image, Image.Image):
+            img = image
+        elif isinstance(image, np.ndarray):
+            # In-memory result from preprocess_image_array - no disk round trip needed
+            # A 2-D array (what preprocessing returns) is already a mode L image
+            img = Image.fromarray(image)
+        else:
+            img = Image.open(image)
+
+        # pix2tex works in grayscale, so hand it mode L and skip its colour conversion
+        # Images with transparency are left alone - pix2tex reads the alpha channel
+        if img.mode != 'L' and 'A' not in img.getbands() and 'transparency' not in img.info:
+            img = img.convert('L')
+        return img
+
+    def _prepare(self, img: Image.Image) -> Image.Image:
+        """
+        Resize and pad one image the same way LatexOCR.__call__ does before the encoder.
+        Returns the padded grayscale image that would be fed to the model.
+        """
+        args = self.model.args
+        img = minmax_size(pad(img), args.max_dimensions, args.min_dimensions)
+        if self.model.image_resizer is None or args.no_resize:
+            return pad(img)
+
+        # pix2tex's small ResNet predicts the best width - repeat until it settles
+        with torch.no_grad():
+            input_image = img.convert('RGB').copy()
+            r, w, h = 1, input_image.size[0], input_image.size[1]
+            for _ in range(10):
+                h = int(h * r)
+                resample = Image.Resampling.BILINEAR if r > 1 else Image.Resampling.LANCZOS
+                img = pad(minmax_size(input_image.resize((w, h), resample), args.max_dimensions, args.min_dimensions))
+                t = test_transform(image=np.array(img.convert('RGB')))['image'][:1].unsqueeze(0)
+                w = (self.model.image_resizer(t.to(args.device)).argmax(-1).item() + 1) * 32
+                if w == img.size[0]:
+                    break
+                r = w / img.size[0]
+        return img
+
+    def _bucket(self, img: Image.Image) -> tuple:
+        """Round an image size up to the nearest bucket, without exceeding the model's max size."""
+        max_width, max_height = self.model.args.max_dimensions
+        width = min(-(-img.size[0] // BUCKET_SIZE) * BUCKET_SIZE, max_width)
+        height = min(-(-img.size[1] // BUCKET_SIZE) * BUCKET_SIZE, max_height)
+        return width, height
+
+
+class MicroBatcher:
+    """
+    Coalesces concurrent predict() calls into batched model calls.
+    Each caller prepares its own image (on its own thread), drops it on a queue and waits;
+    a single worker thread collects up to MAX_BATCH images (or waits at most MAX_WAIT_MS)
+    and runs them through one predict_prepared call.
+    Only images of exactly the same size are batched together, so a result never depends
+    on which other uploads happened to arrive at the same time.
+    """
+
+    def __init__(self, model: Pix2TexModel, max_batch: int = MAX_BATCH, max_wait_ms: int = MAX_WAIT_MS):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        # Each queue entry is (prepared image, event to signal when done, dict to hold the result)
+        self._queue = queue.Queue()
+        # The worker thread is started on first use - threads don't survive a fork, so a
+        # batcher created before Gunicorn forks its workers has to start one in each worker
+        self._worker = None
+        self._worker_pid = None
+        self._worker_lock = threading.Lock()
+        # Set by the worker once the model is warmed up and it is taking requests
+        self._ready = threading.Event()
+
+    def start(self):
+        """
+        Start the worker now and wait until it has warmed up the compiled model, so the slow
+        first compilation happens before the server takes traffic. The warm-up has to run
+        on the worker thread, since that is the thread that runs the model for every request.
+        Does nothing for an uncompiled model - the worker then starts on first use.
+        """
+        if not self.model.is_compiled:
+            return
+        self._ensure_worker()
+        self._ready.wait()
+
+    def predict(self, image) -> str:
+        """
+        Queue one image for recognition and block until its batch has been decoded.
+
+        Returns:
+            LaTeX string for this image
+        """
+        self._ensure_worker()
+        # Resizing and padding (including pix2tex's resizer network) runs here on the
+        # caller's thread, so the worker only does the batched encoder/decoder call
+        prepared = self.model.prepare(image)
+        done = threading.Event()
+        holder = {}
+        self._queue.put((prepared, done, holder))
+        done.wait()
+        if 'error' in holder:
+            raise holder['error']
+        return holder['result']
+
+    def _ensure_worker(self):
+        """Start the worker thread if this process doesn't have one yet."""
+        if self._worker_pid == os.getpid():
+            return
+        with self._worker_lock:
+            if self._worker_pid != os.getpid():
+                # Anything queued before a fork belongs to the parent process
+                self._queue = queue.Queue()
+                self._ready = threading.Event()
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+                self._worker_pid = os.getpid()
+
+    def _run(self):
+        """Worker loop - pull a batch off the queue, run the model, hand results back."""
+        try:
+            self.model.warm_up()
+        except Exception as e:
+            # A failed warm-up only means the first requests compile instead - keep serving
+            print(f"Warning: model warm-up failed: {e}")
+        self._ready.set()
+
+        while True:
+            # Block until at least one request arrives, then gather more until the window closes
+            items = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            try:
+                results = self.model.predict_prepared(
+                    [prepared for prepared, _, _ in items], self.max_batch, exact_sizes=True)
+            except Exception as e:
+                # Every caller in a failed batch gets the same error
+                for _, done, holder in items:
+                    holder['error'] = e
+                    done.set()
+                continue
 
+            for (_, done, holder), result in zip(items, results):
+                holder['result'] = result
+                done.set()
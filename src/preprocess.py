@@ -12,99 +12,213 @@ the original character shapes. Aggressive binary thresholding can destroy
 important details that the model needs.
 """
 
+# Process ID check for the per-process OpenCL setup
+import os
+# Thread-local storage so each server thread keeps its own CLAHE object
+import threading
+
 # OpenCV for image processing operations (blur, threshold, transform, etc.)
 import cv2
 # NumPy for numerical operations and array handling
 import numpy as np
 
 
-def preprocess_image(input_path: str, output_path: str, aggressive: bool = False) -> str:
+# CLAHE objects are built once and reused instead of recreated for every image
+# One per thread, because the web server preprocesses several uploads at the same time
+_CLAHE = threading.local()
+
+# With OpenCL available, images are wrapped in cv2.UMat so OpenCV's transparent API
+# runs blur, CLAHE, threshold and rotation on the GPU/iGPU instead of the CPU
+# Checked on first use in each process, not at import: useOpenCL() sets up an OpenCL
+# context, and most OpenCL drivers break if that context is inherited across a fork
+# (Gunicorn imports this module in the master and forks the workers afterwards)
+_opencl_pid = None
+_opencl_enabled = False
+
+
+def _use_opencl() -> bool:
+    """Whether this process should use OpenCL, checking the first time it's asked."""
+    global _opencl_pid, _opencl_enabled
+    if _opencl_pid != os.getpid():
+        _opencl_enabled = cv2.ocl.haveOpenCL() and cv2.ocl.useOpenCL()
+        _opencl_pid = os.getpid()
+    return _opencl_enabled
+
+
+def _get_clahe():
+    """Return this thread's CLAHE object, creating it on first use."""
+    clahe = getattr(_CLAHE, 'clahe', None)
+    if clahe is None:
+        # Clip limit prevents noise amplification, tile size balances local vs global effects
+        clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
+        _CLAHE.clahe = clahe
+    return clahe
+
+
+# Images whose sampled pixels vary at least this much are already clean enough for pix2tex
+HIGH_CONTRAST_STD = 50
+HIGH_CONTRAST_RANGE = 180
+
+
+def _is_high_contrast(gray: np.ndarray) -> bool:
+    """
+    Cheap check for clean, high-contrast images (screenshots, rendered equations).
+    Looks at about 1% of the pixels instead of the whole image.
+    """
+    # Every 10th row and column - an even grid over the whole image. Taking every 100th
+    # pixel of the flattened image would hit the same few columns whenever the width
+    # is a multiple of 100 (and resized uploads are exactly 800px wide)
+    sample = gray[::10, ::10]
+    std = float(sample.std())
+    contrast = int(sample.max()) - int(sample.min())
+    return std > HIGH_CONTRAST_STD and contrast > HIGH_CONTRAST_RANGE
+
+
+def _avg_angle(lines_theta: np.ndarray) -> float:
     """
-    Preprocess a whiteboard image for LaTeX recognition.
+    Turn Hough line angles into the overall skew of the image.
     
-    Steps:
-    1. Read image
-    2. Convert to grayscale
-    3. Light noise reduction
-    4. Enhance contrast (CLAHE)
-    5. Optional deskew using Hough transform
-    6. Resize to reasonable dimensions
-    7. Save processed image
+    Args:
+        lines_theta: Line angles (theta) from cv2.HoughLines, in radians
+        
+    Returns:
+        Average skew in degrees, or NaN if no line was close enough to horizontal
+    """
+    # Convert from radians and adjust to get rotation angle (all lines at once)
+    angles = lines_theta.astype(np.float64) * (180.0 / np.pi) - 90.0
+    angles = angles[np.abs(angles) < 45]  # Ignore extreme angles (probably errors)
+    if angles.size == 0:
+        return float('nan')
+    # Average all the angles to get the overall skew
+    return float(angles.mean())
+
+
+def preprocess_image(input_path: str, output_path: str, aggressive: bool = False) -> str:
+    """
+    Preprocess a whiteboard image for LaTeX recognition and save the result to disk.
+    See preprocess_image_array for the processing steps.
     
     Args:
         input_path: Path to input whiteboard image
         output_path: Path to save preprocessed image
-        aggressive: If True, apply binary thresholding (may reduce accuracy)
+        aggressive: If True, apply binary thresholding and deskew (may reduce accuracy)
         
     Returns:
         output_path: Path to saved preprocessed image
     """
-    # Read the image from disk - OpenCV loads it in BGR format by default
-    img = cv2.imread(input_path)
-    if img is None:
-        raise ValueError(f"Could not read image from {input_path}")
+    processed = preprocess_image_array(input_path, aggressive)
+    
+    # Write the final processed image to disk
+    # Compression level 1 instead of the default 3: the file is bigger, but it's only a
+    # temporary file and deflate is the most expensive part of writing a PNG
+    cv2.imwrite(output_path, processed, [int(cv2.IMWRITE_PNG_COMPRESSION), 1])
+    
+    return output_path
+
+
+def preprocess_image_array(image, aggressive: bool = False) -> np.ndarray:
+    """
+    Preprocess a whiteboard image for LaTeX recognition, keeping the result in memory.
+    
+    Steps:
+    1. Read image (skipped if an already-decoded array is passed in)
+    2. Resize to reasonable dimensions
+    3. Convert to grayscale (clean high-contrast images stop here unless aggressive)
+    4. Light noise reduction
+    5. Enhance contrast (CLAHE)
+    6. Deskew using Hough transform (aggressive mode only)
+    
+    Args:
+        image: Path to input whiteboard image, or the image itself as a BGR NumPy array
+        aggressive: If True, apply binary thresholding and deskew (may reduce accuracy)
+        
+    Returns:
+        Preprocessed grayscale image as a NumPy array
+    """
+    if isinstance(image, np.ndarray):
+        # Already decoded (e.g. straight from an upload in memory)
+        img = image
+    else:
+        # Read the image from disk - OpenCV loads it in BGR format by default
+        img = cv2.imread(image)
+        if img is None:
+            raise ValueError(f"Could not read image from {image}")
+    
+    # Resize to a standard size that the model likes (around 800px width works well)
+    # Done first so every later step works on the small image instead of the full-size photo
+    # Only shrink if image is larger - keep small images as-is to preserve quality
+    height, width = img.shape[:2]
+    target_width = 800  # Sweet spot for pix2tex - not too big, not too small
+    
+    if width > target_width:
+        # Calculate height to keep proportions correct
+        aspect_ratio = height / width
+        target_height = int(target_width * aspect_ratio)
+        # INTER_AREA is best for shrinking - gives clean results
+        img = cv2.resize(img, (target_width, target_height), interpolation=cv2.INTER_AREA)
     
     # Convert from BGR color to grayscale - simplifies processing and reduces data
     gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
     
+    # Already high-contrast images don't need the cleanup below - blur would only soften
+    # the sharp character edges pix2tex likes and CLAHE would only boost noise
+    # Aggressive mode always runs the full pipeline
+    if not aggressive and _is_high_contrast(gray):
+        return gray
+    
+    # UMat has no .shape, so remember the size while it's still a NumPy array
+    height, width = gray.shape
+    if _use_opencl():
+        # The pixel steps below accept a UMat too and then run on the OpenCL device
+        gray = cv2.UMat(gray)
+    
     # Apply light blur to reduce noise - small 3x3 kernel keeps details while smoothing
     blurred = cv2.GaussianBlur(gray, (3, 3), 0)
     
     # Enhance contrast with CLAHE - divides image into tiles and adjusts contrast locally
-    # Clip limit prevents noise amplification, tile size balances local vs global effects
-    clahe = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8))
-    enhanced = clahe.apply(blurred)
+    enhanced = _get_clahe().apply(blurred)
     
     # Optionally convert to pure black/white if aggressive mode is on
     # Usually skipped since pix2tex works better with grayscale images
     if aggressive:
         # Otsu's method automatically finds the best threshold value
         _, enhanced = cv2.threshold(enhanced, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    
-    # Detect and correct image rotation if it's tilted
-    # First create a binary version just to find lines (we don't keep this)
-    _, temp_binary = cv2.threshold(enhanced, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
-    # Hough transform finds straight lines in the image
-    lines = cv2.HoughLines(temp_binary, 1, np.pi / 180, 200)
-    
-    if lines is not None and len(lines) > 0:
-        # Collect angles from detected lines to find the overall tilt
-        angles = []
-        for line in lines[:20]:  # Sample first 20 lines for speed
-            rho, theta = line[0]
-            # Convert from radians and adjust to get rotation angle
-            angle = (theta * 180 / np.pi) - 90
-            if abs(angle) < 45:  # Ignore extreme angles (probably errors)
-                angles.append(angle)
         
-        if angles:
-            # Average all the angles to get the overall skew
-            avg_angle = np.mean(angles)
-            # Only rotate if there's a meaningful tilt (> 1 degree)
-            if abs(avg_angle) > 1.0:
+        # Detect and correct image rotation if it's tilted
+        # Only done in aggressive mode - Hough is the slowest CV step and pix2tex
+        # rarely needs small tilts corrected
+        # First create an inverted binary version just to find lines (we don't keep this)
+        # enhanced is already black/white here, so inverting it gives the same result
+        # as a second Otsu threshold without another pass over the histogram
+        temp_binary = cv2.bitwise_not(enhanced)
+        # Look for lines on a copy at most 400px wide - far fewer pixels to vote with,
+        # and shrinking evenly doesn't change any line angles
+        scale = min(1.0, 400.0 / width)
+        small = cv2.resize(temp_binary, None, fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
+        if isinstance(small, cv2.UMat):
+            # Hough results are only readable as a NumPy array, and the small copy is cheap to download
+            small = small.get()
+        # Hough transform finds straight lines in the image
+        # Lines get shorter when the image shrinks, so the vote threshold shrinks with them
+        lines = cv2.HoughLines(small, 1, np.pi / 180, max(1, int(200 * scale)))
+        
+        if lines is not None and len(lines) > 0:
+            # lines has shape (N, 1, 2) holding (rho, theta) - take theta of the first 20 lines
+            avg_angle = _avg_angle(lines[:20, 0, 1])  # Sample first 20 lines for speed
+            
+            # Only rotate if there's a meaningful tilt (> 1 degree) - NaN means no usable lines
+            if not np.isnan(avg_angle) and abs(avg_angle) > 1.0:
                 # Create rotation matrix centered on image
-                center = (enhanced.shape[1] // 2, enhanced.shape[0] // 2)
+                center = (width // 2, height // 2)
                 M = cv2.getRotationMatrix2D(center, avg_angle, 1.0)
                 # Apply rotation and fill edges with replicated pixels (no black borders)
-                enhanced = cv2.warpAffine(enhanced, M, (enhanced.shape[1], enhanced.shape[0]), 
+                # The image is pure black/white here, so nearest-neighbour is faster than the
+                # default linear interpolation and doesn't add in-between gray values
+                enhanced = cv2.warpAffine(enhanced, M, (width, height), flags=cv2.INTER_NEAREST,
                                           borderMode=cv2.BORDER_REPLICATE)
     
-    # Resize to a standard size that the model likes (around 800px width works well)
-    # Only shrink if image is larger - keep small images as-is to preserve quality
-    height, width = enhanced.shape
-    target_width = 800  # Sweet spot for pix2tex - not too big, not too small
-    
-    if width > target_width:
-        # Calculate height to keep proportions correct
-        aspect_ratio = height / width
-        target_height = int(target_width * aspect_ratio)
-        # INTER_AREA is best for shrinking - gives clean results
-        resized = cv2.resize(enhanced, (target_width, target_height), interpolation=cv2.INTER_AREA)
-    else:
-        resized = enhanced  # Already small enough, no need to resize
-    
-    # Write the final processed image to disk
-    cv2.imwrite(output_path, resized)
-    
-    return output_path
+    # Copy the result back from the OpenCL device if it was used
+    if isinstance(enhanced, cv2.UMat):
+        enhanced = enhanced.get()
+    return enhanced
 
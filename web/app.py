@@ -6,14 +6,22 @@ This handles the web interface - serving the HTML page and processing image uplo
 # Standard library imports
 import os  # File system operations
 import sys  # Path manipulation
-import uuid  # Generate unique filenames for uploads
+import hashlib  # Fingerprint uploads for the result cache
+import threading  # Protect the result cache from concurrent requests
+from collections import OrderedDict  # Keeps cache entries in least-recently-used order
+
+# OpenCV and NumPy decode uploaded images straight from memory
+import cv2
+import numpy as np
 
 # Flask imports - framework for building the web API
 from flask import Flask, render_template, request, jsonify
+# PIL Image wraps the preprocessed array for the model
+from PIL import Image
 
 # Import our core processing modules and cv model
-from src.preprocess import preprocess_image
-from src.model_infer import Pix2TexModel
+from src.preprocess import preprocess_image_array
+from src.model_infer import Pix2TexModel, MicroBatcher
 
 # Add parent directory to Python path so we can import from src/
 # This is needed because Flask app is in web/ subdirectory
@@ -21,7 +29,6 @@ sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
 
 # Get paths for Flask configuration
 web_dir = os.path.dirname(os.path.abspath(__file__))
-project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 # Create Flask app and tell it where to find HTML templates and CSS/JS files
 app = Flask(
@@ -30,18 +37,51 @@ app = Flask(
     static_folder=os.path.join(web_dir, 'static')
 )
 
-# Configure where to store uploaded images
-app.config['UPLOAD_FOLDER'] = os.path.join(project_root, 'uploads')
+# Configure upload limits - uploads are decoded in memory, so nothing is stored on disk
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # Max 16MB file size
 app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 
-# Create uploads folder if it doesn't exist yet
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
-
 # Load the model once when server starts - this takes time, so we do it once
 # The same model instance is reused for all requests (much faster)
+# On CPU, gunicorn.conf.py preloads the app, so this runs once in the master process and
+# the forked workers share the loaded weights. On GPU it runs inside each worker instead,
+# because CUDA can't be used in a process forked after the model was moved onto the GPU
+# compile=True compiles the model with torch.compile when there is a GPU
 print("Initializing pix2tex model...")
-model = Pix2TexModel()
+model = Pix2TexModel(compile=True)
+# Requests arriving within a few milliseconds of each other share one batched model call
+batcher = MicroBatcher(model)
+# Run the slow first compilation on the batcher's thread before the server accepts traffic
+batcher.start()
+
+# Results for recently seen images, keyed by a hash of the uploaded bytes
+# Re-uploading the same image (common while editing) skips preprocessing and the model entirely
+RESULT_CACHE_SIZE = 256
+result_cache = OrderedDict()
+result_cache_lock = threading.Lock()
+
+
+def get_cached_result(key):
+    """
+    Look up a previous LaTeX result, marking it as recently used.
+    Returns None if this image hasn't been seen.
+    """
+    with result_cache_lock:
+        latex_result = result_cache.get(key)
+        if latex_result is not None:
+            result_cache.move_to_end(key)
+        return latex_result
+
+
+def cache_result(key, latex_result):
+    """
+    Remember a LaTeX result, dropping the least recently used one when the cache is full.
+    """
+    with result_cache_lock:
+        result_cache[key] = latex_result
+        result_cache.move_to_end(key)
+        if len(result_cache) > RESULT_CACHE_SIZE:
+            result_cache.popitem(last=False)
 
 
 def allowed_file(filename):
@@ -82,31 +122,33 @@ def process_image():
         return jsonify({'error': 'Invalid file type. Allowed: PNG, JPG, JPEG, GIF, BMP'}), 400
     
     try:
-        # Generate unique filenames using UUID so multiple users can upload simultaneously
-        # without overwriting each other's files
-        file_ext = file.filename.rsplit('.', 1)[1].lower()
-        unique_id = str(uuid.uuid4())
-        input_filename = f"input_{unique_id}.{file_ext}"
-        preprocessed_filename = f"preprocessed_{unique_id}.png"
+        # Decode the upload straight from memory - nothing is written to disk
+        data = file.read()
         
-        input_path = os.path.join(app.config['UPLOAD_FOLDER'], input_filename)
-        preprocessed_path = os.path.join(app.config['UPLOAD_FOLDER'], preprocessed_filename)
+        # Same bytes as an earlier upload? Return that result straight away
+        # blake2b is faster than sha256 and plenty for a cache key
+        cache_key = hashlib.blake2b(data, digest_size=16).hexdigest()
+        latex_result = get_cached_result(cache_key)
+        if latex_result is not None:
+            return jsonify({
+                'success': True,
+                'latex': latex_result
+            })
         
-        # Save the uploaded file to disk
-        file.save(input_path)
+        img = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            return jsonify({'error': 'Could not read the uploaded image'}), 400
         
-        # Step 1: Clean up and enhance the image (grayscale, blur, contrast, deskew, resize)
-        preprocess_image(input_path, preprocessed_path)
+        # Step 1: Clean up and enhance the image (grayscale, blur, contrast, resize)
+        # The result stays in memory - no need to write it out and read it back
+        preprocessed = Image.fromarray(preprocess_image_array(img))
         
         # Step 2: Run the pic2text model to convert image to LaTeX text
-        latex_result = model.predict(preprocessed_path)
-        
-        # Delete temporary files to save disk space
-        try:
-            os.remove(input_path)
-            os.remove(preprocessed_path)
-        except:
-            pass  # If cleanup fails, it's not critical - just continue
+        # Goes through the micro-batcher so concurrent uploads are decoded together
+        latex_result = batcher.predict(preprocessed)
+        # Safe to cache: the batcher never pads an upload to fit other users' images,
+        # so this result doesn't depend on what else was in the batch
+        cache_result(cache_key, latex_result)
         
         # Send success response with the LaTeX code
         return jsonify({
@@ -115,21 +157,15 @@ def process_image():
         })
     
     except Exception as e:
-        # If anything goes wrong, try to clean up files and return error message
-        try:
-            if 'input_path' in locals() and os.path.exists(input_path):
-                os.remove(input_path)
-            if 'preprocessed_path' in locals() and os.path.exists(preprocessed_path):
-                os.remove(preprocessed_path)
-        except:
-            pass
-        
-        # Return error response with details
+        # If anything goes wrong, return error response with details
         return jsonify({
             'success': False,
             'error': str(e)
         }), 500
 
 #when app is ran, init the flask server on port 5001, discoverable on local network ip
+# This is the development server - in production run it with Gunicorn (see gunicorn.conf.py)
 if __name__ == '__main__':
-    app.run(debug=True, host='0.0.0.0', port=5001)
+    # Debug mode is opt-in via FLASK_DEBUG=1; the reloader stays off because it would
+    # start a second process and load the whole model a second time
+    app.run(debug=os.environ.get('FLASK_DEBUG') == '1', use_reloader=False, host='0.0.0.0', port=5001)